@@ -9,16 +9,24 @@ from    pathlib             import  Path
 
 import  sys
 import  glob
+import  copy
 import  numpy as np
 import  re
 import  time
+import  socket
 import  pudb
 from    scipy               import  ndimage
+from    scipy               import  special
 # System dependency imports
 import  nibabel              as      nib
 import  pydicom              as      dicom
+from    pydicom.uid         import  ImplicitVRLittleEndian, ExplicitVRLittleEndian
+from    pydicom.pixel_data_handlers.util    import  pixel_dtype
+from    pydicom.encaps      import  generate_pixel_data_frame, encapsulate
+from    concurrent.futures  import  ThreadPoolExecutor
 import  pylab
 import  matplotlib.cm        as      cm
+from    PIL                 import  Image
 
 import  pfmisc
 from    pfmisc._colors      import  Colors
@@ -134,7 +142,11 @@ class med2image(object):
         'PatientSexTag': {
             'action':           'attempting to parse DICOM header, ',
             'error':            'the DICOM file does not seem to contain a PatientSex tag.',
-            'exitCode':         46}
+            'exitCode':         46},
+        'manifestFail': {
+            'action':           'attempting to read the shared work manifest, ',
+            'error':            'the manifest could not be found. Has it been created with --manifestCreate?',
+            'exitCode':         50}
     }
 
     @staticmethod
@@ -241,6 +253,7 @@ class med2image(object):
         self._Mnp_2Dslice               = None
         self._dcm                       = None
         self._dcmList                   = []
+        self._s_badSlices               = set()
 
         self.verbosity                  = 1
 
@@ -253,6 +266,42 @@ class med2image(object):
         self.rot                        = '110'
         self.rotAngle                   = 90
 
+        # Empty/background slice handling
+        self._b_skipEmptySlices         = False
+        self._b_emptySlicePlaceholder   = False
+        self.f_emptySliceThreshold      = 0.0
+        self._d_emptySliceIndex         = {}
+
+        # Checkpoint journal
+        self._b_checkpoint              = False
+        self.str_journalFile            = ''
+        self._s_journalDone             = set()
+        self._l_journalErrors           = []
+
+        # Sharded execution via a shared work manifest
+        self.str_manifestDir            = ''
+        self._b_manifestCreate          = False
+        self.shardSize                  = 0
+        self.leaseTime                  = 600
+        self._str_lease                 = ''
+
+        # Voxel spacing aware resampling
+        self._b_resample                = False
+        self.f_resampleSpacing          = 0.0
+        self.l_spacing                  = [1.0, 1.0, 1.0]
+        self._d_resampleGrid            = {}
+        self.resampleChunk              = 64
+
+        # Resolution pyramid sizes (max pixel extent) per saved slice
+        self.l_pyramid                  = []
+
+        # Whole series outputs: montages and animations
+        self._b_montage                 = False
+        self.montageColumns             = 0
+        self._b_animate                 = False
+        self.frameDuration              = 100
+        self._d_animation               = {}
+
         for key, value in kwargs.items():
             if key == "inputFile":              self.str_inputFile          = value
             if key == "inputFileSubStr":        self.str_inputFileSubStr    = value
@@ -270,6 +319,22 @@ class med2image(object):
             if key == "verbosity":              self.verbosity              = int(value)
             if key == "rot":                    self.rot                    = value
             if key == "rotAngle":               self.rotAngle               = int(value)
+            if key == "skipEmptySlices":        self._b_skipEmptySlices     = value
+            if key == "emptySlicePlaceholder":  self._b_emptySlicePlaceholder = value
+            if key == "emptySliceThreshold":    self.f_emptySliceThreshold  = float(value)
+            if key == "checkpoint":             self._b_checkpoint          = value
+            if key == "manifestDir":            self.str_manifestDir        = value
+            if key == "manifestCreate":         self._b_manifestCreate      = value
+            if key == "shardSize":              self.shardSize              = int(value)
+            if key == "leaseTime":              self.leaseTime              = int(value)
+            if key == "resample":               self._b_resample            = value
+            if key == "resampleSpacing":        self.f_resampleSpacing      = float(value or 0)
+            if key == "montage":                self._b_montage             = value
+            if key == "montageColumns":         self.montageColumns         = int(value)
+            if key == "animate":                self._b_animate             = value
+            if key == "frameDuration":          self.frameDuration          = int(value)
+            if key == "pyramid":                self.l_pyramid              = [int(size) for size in
+                                                                                str(value).split(',') if len(size)]
 
         # A logger
         self.dp                         = pfmisc.debug(
@@ -303,6 +368,39 @@ class med2image(object):
         if not len(self.str_outputFileType) and not len(str_fileExtension):
             self.str_outputFileType     = 'png'
 
+        if len(self.l_pyramid) and self.str_outputFileType.endswith('dcm'):
+            raise ValueError('resolution pyramid not available for dcm output format')
+        if self._b_montage and self.str_outputFileType.endswith('dcm'):
+            raise ValueError('montage not available for dcm output format')
+        if self._b_animate and self.str_outputFileType.split('.')[-1] not in ['png', 'gif']:
+            raise ValueError('animated output only available for png and gif output formats')
+        if (self._b_montage or self._b_animate) and len(self.str_manifestDir):
+            raise ValueError('montage and animated outputs cannot be sharded with a manifest')
+        if self._b_resample and (self.str_outputFileType.endswith('dcm') or self.preserveDICOMinputName):
+            raise ValueError('resampled slices do not match the input DICOM files, '
+                             'and cannot be saved as dcm or with the input file names')
+
+    def warn(self, str_tag, str_extraMsg = '', b_exit = False):
+        '''
+        Print a warning using the passed <str_tag>
+        '''
+        str_action      = med2image._dictErr[str_tag]['action']
+        str_error       = med2image._dictErr[str_tag]['error']
+        exitCode        = med2image._dictErr[str_tag]['exitCode']
+        self.LOG(
+            'Some error seems to have occured!', comms = 'error'
+        )
+        self.LOG(
+            'While %s' % str_action, comms = 'error'
+        )
+        self.LOG(
+            '%s' % str_error, comms = 'error'
+        )
+        if len(str_extraMsg):
+            self.LOG(str_extraMsg, comms = 'error')
+        if b_exit:
+            sys.exit(exitCode)
+
     def tic(self):
         """
             Port of the MatLAB function of same name
@@ -366,33 +464,500 @@ class med2image(object):
         else:
             return self.str_workingDir
 
+    @staticmethod
+    def output_file_sized(astr_outputFile, size):
+        '''
+        The name of the <size> pyramid level of <astr_outputFile>.
+        '''
+        if not size:
+            return astr_outputFile
+        str_root, str_ext   = os.path.splitext(astr_outputFile)
+        return '%s-%dpx%s' % (str_root, size, str_ext)
+
     def get_output_file_name(self, **kwargs):
         index   = 0
         frame   = 0
+        size    = 0
         str_subDir  = ""
+        str_part    = ""
+        b_animated  = False
         for key,val in kwargs.items():
-            if key == 'index':  index       = val
-            if key == 'frame':  frame       = val
-            if key == 'subDir': str_subDir  = val
-
-        if self._b_4D:
-            str_outputFile = '%s/%s/%s-frame%03d-slice%03d.%s' % (
+            if key == 'index':      index       = val
+            if key == 'frame':      frame       = val
+            if key == 'subDir':     str_subDir  = val
+            if key == 'size':       size        = val
+            if key == 'part':       str_part    = val
+            if key == 'animated':   b_animated  = val
+
+        # <part> replaces the slice index in the name of a whole series
+        # output, such as a 'montage'. An <animated> output spans all
+        # frames, so has no frame index.
+        str_slicePart   = str_part if len(str_part) else 'slice%03d' % index
+        if self._b_4D and not b_animated:
+            str_outputFile = '%s/%s/%s-frame%03d-%s.%s' % (
                                                     self.str_outputDir,
                                                     str_subDir,
                                                     self.str_outputFileStem,
-                                                    frame, index,
+                                                    frame, str_slicePart,
                                                     self.str_outputFileType)
         else:
-            if self.preserveDICOMinputName and (str_subDir == 'z' or str_subDir == ''):
+            if self.preserveDICOMinputName and (str_subDir == 'z' or str_subDir == '') \
+               and not len(str_part):
                 str_filePart    = os.path.splitext(self.lstr_inputFile[index])[0]
             else:
-                str_filePart    = '%s-slice%03d' % (self.str_outputFileStem, index)
+                str_filePart    = '%s-%s' % (self.str_outputFileStem, str_slicePart)
             str_outputFile      = '%s/%s/%s.%s' % (
                                         self.str_outputDir,
                                         str_subDir,
                                         str_filePart,
                                         self.str_outputFileType)
-        return str_outputFile
+        return med2image.output_file_sized(str_outputFile, size)
+
+    @staticmethod
+    def block_average(Vnp, factor, l_axis):
+        '''
+        Downsample <Vnp> by <factor> along each axis in <l_axis>, by
+        averaging (possibly smaller, trailing) blocks of <factor> samples.
+        '''
+        for axis in l_axis:
+            n               = Vnp.shape[axis]
+            v_start         = np.arange(0, n, factor)
+            l_shape         = [1] * Vnp.ndim
+            l_shape[axis]   = len(v_start)
+            v_count         = np.diff(np.append(v_start, n)).reshape(l_shape)
+            Vnp             = np.add.reduceat(Vnp, v_start, axis = axis, dtype = float) / v_count
+        return Vnp
+
+    def slice_extent(self, l_shape, b_rot90 = False):
+        '''
+        The largest side of a slice of (in-plane) <l_shape> once saved,
+        i.e. after any rotation by process_slice(), which grows the image
+        to hold all of the rotated slice (as ndimage.rotate does).
+        '''
+        if not b_rot90:
+            return max(l_shape)
+        c, s        = abs(special.cosdg(self.rotAngle)), abs(special.sindg(self.rotAngle))
+        h, w        = l_shape
+        return max(int(c * h + s * w + 0.5), int(s * h + c * w + 0.5))
+
+    def pyramid_levels(self, Vnp, l_axis, b_rot90 = False):
+        '''
+        Return a dictionary of the <pyramid> levels of <Vnp>, keyed by
+        size. Each level is downsampled along the (image plane) axes in
+        <l_axis> by the smallest integer factor that brings the extent
+        of the saved, possibly rotated (<b_rot90>), image within its size.
+        '''
+        d_level     = {}
+        l_shape     = [Vnp.shape[axis] for axis in l_axis]
+        for size in self.l_pyramid:
+            factor          = max(1, self.slice_extent(l_shape, b_rot90) // size)
+            while self.slice_extent([-(-n // factor) for n in l_shape], b_rot90) > size:
+                factor      += 1
+            d_level[size]   = med2image.block_average(Vnp, factor, l_axis)
+        return d_level
+
+    @staticmethod
+    def montage_tile(l_image, columns = 0):
+        '''
+        Tile the equally sized 2D images in <l_image> row by row into a
+        single montage image of <columns> (default about square) columns.
+        Unused tiles are filled with the minimum intensity.
+        '''
+        Vnp             = np.stack(l_image)
+        n, h, w         = Vnp.shape[0:3]
+        if columns <= 0:
+            columns     = int(np.ceil(np.sqrt(n)))
+        rows            = int(np.ceil(n / columns))
+        Vnp_tile        = np.full((rows * columns,) + Vnp.shape[1:], Vnp.min(), dtype = float)
+        Vnp_tile[0:n]   = Vnp
+        Vnp_tile        = Vnp_tile.reshape((rows, columns) + Vnp.shape[1:])
+        return Vnp_tile.swapaxes(1, 2).reshape((rows * h, columns * w) + Vnp.shape[3:])
+
+    def animation_append(self, str_outputFile, Mnp_image):
+        '''
+        Add <Mnp_image> as the next frame of animated output <str_outputFile>.
+        '''
+        self._d_animation.setdefault(str_outputFile, []).append(np.array(Mnp_image))
+
+    def animations_save(self):
+        '''
+        Save all the collected animations, as APNG or GIF depending on the
+        output file type. All frames of an animation share one intensity
+        scaling, so that intensity changes over time are preserved.
+        '''
+        for str_outputFile, l_image in self._d_animation.items():
+            Vnp             = np.stack(l_image).astype(float)
+            f_range         = Vnp.max() - Vnp.min()
+            Vnp             = (Vnp - Vnp.min()) / (f_range if f_range else 1)
+            Vnp_rgb         = (cm.Greys_r(Vnp)[..., 0:3] * 255).astype(np.uint8)
+            l_frame         = [Image.fromarray(M) for M in Vnp_rgb]
+            str_dir, str_file   = os.path.split(str_outputFile)
+            str_tmpFile     = os.path.join(str_dir, '.%s.tmp' % str_file)
+            l_frame[0].save(str_tmpFile,
+                            format          = str_outputFile.split('.')[-1].upper(),
+                            save_all        = True,
+                            append_images   = l_frame[1:],
+                            duration        = self.frameDuration,
+                            loop            = 0)
+            os.replace(str_tmpFile, str_outputFile)
+            self.LOG('Animation of %d frames saved to %s' % (len(l_frame), str_outputFile))
+        self._d_animation   = {}
+
+    def empty_slices_find(self, str_dim, indexStart, indexStop):
+        '''
+        Return a boolean vector, one entry per slice <indexStart> to
+        <indexStop> along <str_dim>, flagging slices whose intensity
+        range (max - min) does not exceed the empty slice threshold.
+
+        The statistic is computed once over these slices in a single
+        vectorized reduction, rather than per slice, and only reads
+        (or, for multi-frame data, decodes) the slices to convert.
+        '''
+        dim_ix                      = {'x':0, 'y':1, 'z':2}
+        axes                        = tuple(a for a in range(3) if a != dim_ix[str_dim])
+        l_range                     = [slice(None)] * 3
+        l_range[dim_ix[str_dim]]    = slice(indexStart, indexStop)
+        v_range     = np.ptp(np.asarray(self._Vnp_3DVol[tuple(l_range)]), axis = axes)
+        return v_range <= self.f_emptySliceThreshold
+
+    def empty_slice_record(self, str_outputFile, str_subDir):
+        '''
+        Record that <str_outputFile> was not written because its slice
+        is empty, by appending it to an index file in the output (sub)dir
+        that maps it to a single shared placeholder image.
+
+        The index is only ever appended to, and the placeholder (the
+        current, blank, slice) is only saved if it does not exist yet, so
+        that concurrent (sharded) workers and resumed runs can share them.
+        '''
+        str_placeholder = '%s-empty.%s' % (
+                                    self.str_outputFileStem,
+                                    self.str_outputFileType)
+        str_index       = '%s/%s/%s-empty.txt' % (
+                                    self.str_outputDir,
+                                    str_subDir,
+                                    self.str_outputFileStem)
+        if str_index not in self._d_emptySliceIndex:
+            self._d_emptySliceIndex[str_index] = str_placeholder
+            str_file    = '%s/%s/%s' % (self.str_outputDir, str_subDir, str_placeholder)
+            if not os.path.isfile(str_file):
+                # The placeholder is saved under a name of this worker's
+                # own, and published with a (hard) link, which fails if
+                # another worker published it first. It is thus never
+                # overwritten, nor ever seen only partly written.
+                str_tmpFile = '%s/%s/.%s-%d-%s' % (self.str_outputDir, str_subDir,
+                                                    socket.gethostname(), os.getpid(),
+                                                    str_placeholder)
+                self.slice_save(str_tmpFile)
+                try:
+                    os.link(str_tmpFile, str_file)
+                except FileExistsError:
+                    pass
+                os.remove(str_tmpFile)
+        with open(str_index, 'a') as f:
+            f.write('%s %s\n' % (os.path.basename(str_outputFile), str_placeholder))
+
+    def journal_open(self):
+        '''
+        If checkpointing, read the journal of any previous (interrupted)
+        run in the output directory so that already completed units are
+        skipped, and record any input errors of this run.
+
+        The journal is a text file with one line per event, either
+
+            done <frame> <dimension> <index>
+            error <inputFile> <message>
+        '''
+        if not self._b_checkpoint:
+            return
+        self.str_journalFile = '%s/%s-journal.txt' % (
+                                    self.str_outputDir,
+                                    self.str_outputFileStem)
+        if os.path.isfile(self.str_journalFile):
+            with open(self.str_journalFile) as f:
+                for str_line in f:
+                    l_field = str_line.split()
+                    if len(l_field) == 4 and l_field[0] == 'done':
+                        self._s_journalDone.add(
+                            (int(l_field[1]), l_field[2], int(l_field[3])))
+            self.LOG('Resuming from checkpoint journal %s (%d units done).' %
+                        (self.str_journalFile, len(self._s_journalDone)))
+        for str_error in self._l_journalErrors:
+            self.journal_write('error %s' % str_error)
+
+    def journal_write(self, str_line):
+        '''
+        Append a single line to the checkpoint journal, forcing it to
+        disk so that a completed unit is never lost on interruption.
+        '''
+        with open(self.str_journalFile, 'a') as f:
+            f.write('%s\n' % str_line)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def journal_unitDone(self, frame, str_dim, index):
+        '''
+        Check if the <frame>, <str_dim>, <index> unit was completed
+        in a previous run.
+        '''
+        return (frame, str_dim, index) in self._s_journalDone
+
+    def journal_unitRecord(self, frame, str_dim, index):
+        '''
+        Record the <frame>, <str_dim>, <index> unit as completed.
+        '''
+        if not self._b_checkpoint:
+            return
+        self._s_journalDone.add((frame, str_dim, index))
+        self.journal_write('done %d %s %d' % (frame, str_dim, index))
+
+    def resample_spacing(self):
+        '''
+        The target (isotropic) voxel spacing of a resampled volume: the
+        <resampleSpacing> if given, else the finest spacing of the volume.
+        '''
+        if self.f_resampleSpacing > 0:
+            return self.f_resampleSpacing
+        return min(self.l_spacing)
+
+    def resample_grid(self, n, f_spacingIn, f_spacingOut):
+        '''
+        Return (and cache) the linear interpolation grid that resamples
+        <n> samples at <f_spacingIn> to <f_spacingOut>, as the lower and
+        upper source index and the weight of the upper one, for each
+        output sample.
+        '''
+        key     = (n, f_spacingIn, f_spacingOut)
+        if key not in self._d_resampleGrid:
+            m       = int(round((n - 1) * f_spacingIn / f_spacingOut)) + 1
+            v_pos   = np.arange(m) * f_spacingOut / f_spacingIn
+            v_pos   = np.clip(v_pos, 0, n - 1)
+            v_i0    = np.floor(v_pos).astype(int)
+            v_i1    = np.minimum(v_i0 + 1, n - 1)
+            self._d_resampleGrid[key] = (v_i0, v_i1, v_pos - v_i0)
+        return self._d_resampleGrid[key]
+
+    def resample_shape(self, dims):
+        '''
+        The shape of a resampled volume of shape <dims>.
+        '''
+        if not self._b_resample:
+            return tuple(dims)
+        f_spacing   = self.resample_spacing()
+        return tuple(len(self.resample_grid(dims[a], self.l_spacing[a], f_spacing)[0])
+                        for a in range(3))
+
+    def resample_indices(self, s_index, n, axis):
+        '''
+        Return the set of resampled indices along <axis> (of <n> samples)
+        that are interpolated from any of the source indices in <s_index>.
+        '''
+        f_spacing   = self.resample_spacing()
+        if not len(s_index) or self.l_spacing[axis] == f_spacing:
+            return set(s_index)
+        v_i0, v_i1, v_w = self.resample_grid(n, self.l_spacing[axis], f_spacing)
+        return set(j for j in range(len(v_w))
+                        if v_i0[j] in s_index or (v_w[j] > 0 and v_i1[j] in s_index))
+
+    def volume_resample(self, Vnp_vol):
+        '''
+        Resample <Vnp_vol> to an isotropic voxel spacing, so that slices
+        along any dimension are geometrically correct.
+
+        Each axis is resampled in turn by linear interpolation, using the
+        cached grid for that axis. The interpolation is vectorized over
+        whole chunks of <resampleChunk> planes at a time, which bounds the
+        temporary memory needed.
+        '''
+        f_spacing   = self.resample_spacing()
+        for axis in range(3):
+            if self.l_spacing[axis] == f_spacing:
+                continue
+            v_i0, v_i1, v_w = self.resample_grid(Vnp_vol.shape[axis],
+                                                 self.l_spacing[axis], f_spacing)
+            l_shape         = [1, 1, 1]
+            l_shape[axis]   = len(v_w)
+            v_w             = v_w.reshape(l_shape)
+            chunkAxis       = (axis + 1) % 3
+            l_outShape      = list(Vnp_vol.shape)
+            l_outShape[axis] = len(v_w.ravel())
+            Vnp_out         = np.empty(l_outShape)
+            for start in range(0, Vnp_vol.shape[chunkAxis], self.resampleChunk):
+                l_chunk             = [slice(None)] * 3
+                l_chunk[chunkAxis]  = slice(start, start + self.resampleChunk)
+                Vnp_chunk           = np.asarray(Vnp_vol[tuple(l_chunk)], dtype = float)
+                Vnp_out[tuple(l_chunk)] = \
+                    Vnp_chunk.take(v_i0, axis = axis) * (1 - v_w) + \
+                    Vnp_chunk.take(v_i1, axis = axis) * v_w
+            Vnp_vol         = Vnp_out
+        return Vnp_vol
+
+    def units_enumerate(self):
+        '''
+        Return the list of work units of a conversion. Each unit is a
+        dictionary of keyword arguments to dim_save(), with a resolved
+        'indexStart' and 'indexStop'.
+
+        Overridden by subclasses.
+        '''
+        return []
+
+    def unit_save(self, d_unit):
+        '''
+        Convert a single work unit as returned by units_enumerate().
+        '''
+        self.dim_save(**d_unit)
+
+    def units_convert(self):
+        '''
+        Convert all the work units, either directly or, if a
+        <manifestDir> is given, by creating or working off a shared
+        work manifest.
+        '''
+        if len(self.str_manifestDir):
+            if self._b_manifestCreate:
+                self.manifest_create()
+            else:
+                self.manifest_work()
+        else:
+            for d_unit in self.units_enumerate():
+                self.unit_save(d_unit)
+
+    def manifest_create(self):
+        '''
+        Write all the work units of this conversion, split into chunks
+        of at most <shardSize> slices, to the manifest in <manifestDir>.
+
+        Each line of the manifest is one unit:
+
+            <frame> <dimension> <indexStart> <indexStop> <rot90> <makeSubDir>
+        '''
+        l_unit  = []
+        for d_unit in self.units_enumerate():
+            step    = self.shardSize
+            if step <= 0:
+                step = d_unit['indexStop'] - d_unit['indexStart']
+            for start in range(d_unit['indexStart'], d_unit['indexStop'], step):
+                d_shard                 = dict(d_unit)
+                d_shard['indexStart']   = start
+                d_shard['indexStop']    = min(start + step, d_unit['indexStop'])
+                l_unit.append(d_shard)
+        med2image.mkdir(self.str_manifestDir)
+        str_manifest    = '%s/manifest.txt' % self.str_manifestDir
+        with open(str_manifest + '.tmp', 'w') as f:
+            for d_unit in l_unit:
+                f.write('%d %s %d %d %d %d\n' % (
+                            d_unit['frame'],        d_unit['dimension'],
+                            d_unit['indexStart'],   d_unit['indexStop'],
+                            d_unit['rot90'],        d_unit['makeSubDir']))
+        os.replace(str_manifest + '.tmp', str_manifest)
+        self.LOG('%d work units written to manifest %s' % (len(l_unit), str_manifest))
+
+    def manifest_read(self):
+        '''
+        Read the units of the manifest in <manifestDir>.
+        '''
+        str_manifest    = '%s/manifest.txt' % self.str_manifestDir
+        l_unit          = []
+        if not os.path.isfile(str_manifest):
+            self.warn('manifestFail', '\nManifest %s not found.' % str_manifest, True)
+        with open(str_manifest) as f:
+            for str_line in f:
+                l_field = str_line.split()
+                l_unit.append({
+                    'frame':        int(l_field[0]),
+                    'dimension':    l_field[1],
+                    'indexStart':   int(l_field[2]),
+                    'indexStop':    int(l_field[3]),
+                    'rot90':        bool(int(l_field[4])),
+                    'makeSubDir':   bool(int(l_field[5]))
+                })
+        return l_unit
+
+    def manifest_unitClaim(self, unit):
+        '''
+        Try to claim the lease on manifest unit number <unit>.
+
+        Leases are files 'unit<unit>.lease.<generation>' created with an
+        exclusive open, so that of several workers only one can create a
+        given generation. A lease expires once it is older than
+        <leaseTime> seconds, at which point the next generation can be
+        claimed by any worker. The holder keeps its lease from expiring
+        with manifest_leaseRenew().
+        '''
+        str_stem    = '%s/unit%05d.lease.' % (self.str_manifestDir, unit)
+        l_gen       = [int(f.split('.')[-1]) for f in glob.glob(str_stem + '*')]
+        gen         = max(l_gen) if len(l_gen) else -1
+        if gen >= 0:
+            try:
+                age = time.time() - os.path.getmtime('%s%d' % (str_stem, gen))
+            except OSError:
+                return False
+            if age < self.leaseTime:
+                return False
+        try:
+            fd = os.open('%s%d' % (str_stem, gen + 1),
+                         os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        os.write(fd, ('%s %d\n' % (socket.gethostname(), os.getpid())).encode())
+        os.close(fd)
+        self._str_lease = '%s%d' % (str_stem, gen + 1)
+        return True
+
+    def manifest_leaseRenew(self):
+        '''
+        Heartbeat of the lease held on the current manifest unit (if
+        any): touch it, so that it does not expire while the unit is
+        still being converted.
+        '''
+        if len(self._str_lease):
+            try:
+                os.utime(self._str_lease, None)
+            except OSError:
+                pass
+
+    def manifest_unitDone(self, unit, *args):
+        '''
+        Get/set the done state of manifest unit number <unit>.
+        '''
+        str_done    = '%s/unit%05d.done' % (self.str_manifestDir, unit)
+        if len(args) and args[0]:
+            with open(str_done, 'w') as f:
+                f.write('%s %d\n' % (socket.gethostname(), os.getpid()))
+        return os.path.isfile(str_done)
+
+    def manifest_work(self):
+        '''
+        Act as a worker on the manifest in <manifestDir>: repeatedly
+        claim a pending unit, convert it and mark it as done, until all
+        units are done. Units leased by other workers are waited on, and
+        reclaimed should their lease expire.
+        '''
+        l_unit      = self.manifest_read()
+        workCount   = 0
+        while True:
+            b_pending   = False
+            b_claimed   = False
+            for unit, d_unit in enumerate(l_unit):
+                if self.manifest_unitDone(unit):
+                    continue
+                b_pending = True
+                if self.manifest_unitClaim(unit):
+                    b_claimed = True
+                    # The unit may have been completed by the worker whose
+                    # lease expired, since it was checked above.
+                    if not self.manifest_unitDone(unit):
+                        self.unit_save(d_unit)
+                        self.manifest_unitDone(unit, True)
+                        workCount += 1
+                    self._str_lease = ''
+            if not b_pending:
+                break
+            if not b_claimed:
+                time.sleep(1)
+        self.LOG('%d of %d manifest units converted by this worker.' %
+                    (workCount, len(l_unit)))
 
     def dim_save(self, **kwargs):
         dims            = self._Vnp_3DVol.shape
@@ -419,18 +984,79 @@ class med2image(object):
         if indexStart == 0 and indexStop == -1:
             indexStop = dims[dim_ix[str_dim]]
         self.LOG('Saving along "%s" dimension with %i degree rotation...' % (str_dim, self.rotAngle*b_rot90))
+        b_emptySlice    = None
+        emptyCount      = 0
+        if self._b_skipEmptySlices:
+            b_emptySlice = self.empty_slices_find(str_dim, indexStart, indexStop)
+        b_collect       = self._b_montage or self._b_animate
+        l_tile          = []
+        d_level         = {}
+        if len(self.l_pyramid) and not b_collect:
+            # All pyramid levels of the slices to save are computed at once
+            l_range                     = [slice(None)] * 3
+            l_range[dim_ix[str_dim]]    = slice(indexStart, indexStop)
+            d_level     = self.pyramid_levels(
+                                np.asarray(self._Vnp_3DVol[tuple(l_range)]),
+                                [a for a in range(3) if a != dim_ix[str_dim]], b_rot90)
         for i in range(indexStart, indexStop):
+            self.manifest_leaseRenew()
+            if self.journal_unitDone(frame, str_dim, i):
+                continue
+            if str_dim == 'z' and i in self._s_badSlices:
+                continue
+            str_outputFile = self.get_output_file_name(index=i, subDir=str_subDir, frame=frame)
+            b_empty = b_emptySlice is not None and b_emptySlice[i - indexStart]
+            if b_empty and not b_collect:
+                emptyCount += 1
+                if not self._b_emptySlicePlaceholder:
+                    continue
             if str_dim == 'x':
                 self._Mnp_2Dslice = self._Vnp_3DVol[i, :, :]
             elif str_dim == 'y':
                 self._Mnp_2Dslice = self._Vnp_3DVol[:, i, :]
             else:
                 self._Mnp_2Dslice = self._Vnp_3DVol[:, :, i]
+            if b_empty:
+                # An empty slice is saved as a blank (uniform) image: the
+                # shared placeholder or, so that montages and animations
+                # keep the same layout in every frame, a tile or frame.
+                self._Mnp_2Dslice = np.full(self._Mnp_2Dslice.shape, np.min(self._Mnp_2Dslice))
             self.process_slice(b_rot90)
-            str_outputFile = self.get_output_file_name(index=i, subDir=str_subDir, frame=frame)
+            if b_collect:
+                if self._b_montage:
+                    l_tile.append(self._Mnp_2Dslice)
+                elif self._b_4D:
+                    self.animation_append(self.get_output_file_name(
+                            index=i, subDir=str_subDir, animated=True), self._Mnp_2Dslice)
+                else:
+                    self.animation_append(self.get_output_file_name(
+                            subDir=str_subDir, part='slices'), self._Mnp_2Dslice)
+                continue
             if str_outputFile.endswith('dcm'):
                 self._dcm = self._dcmList[i]
+            if b_empty:
+                self.empty_slice_record(str_outputFile, str_subDir)
+                self.journal_unitRecord(frame, str_dim, i)
+                continue
             self.slice_save(str_outputFile)
+            for size, Vnp_level in d_level.items():
+                l_index                     = [slice(None)] * 3
+                l_index[dim_ix[str_dim]]    = i - indexStart
+                self._Mnp_2Dslice           = Vnp_level[tuple(l_index)]
+                self.process_slice(b_rot90)
+                self.slice_save(self.get_output_file_name(index=i, subDir=str_subDir,
+                                                          frame=frame, size=size))
+            self.journal_unitRecord(frame, str_dim, i)
+        if len(l_tile):
+            self._Mnp_2Dslice = med2image.montage_tile(l_tile, self.montageColumns)
+            if self._b_animate and self._b_4D:
+                self.animation_append(self.get_output_file_name(
+                        subDir=str_subDir, part='montage', animated=True), self._Mnp_2Dslice)
+            else:
+                self.slice_save(self.get_output_file_name(
+                        subDir=str_subDir, frame=frame, part='montage'))
+        if emptyCount:
+            self.LOG('%d empty slices skipped along "%s" dimension' % (emptyCount, str_dim))
         self.LOG('%d images saved along "%s" dimension' % ((i+1), str_dim),
                 end = '')
         if self.func:
@@ -458,15 +1084,20 @@ class med2image(object):
         self.LOG('Input file = %s' % self.str_inputFile, level = 3)
         self.LOG('Outputfile = %s' % astr_outputFile, level = 3)
         fformat = astr_outputFile.split('.')[-1]
+        # Write to a temporary file in the same directory and rename, so
+        # that an interrupted run never leaves a partial output behind.
+        str_dir, str_file   = os.path.split(astr_outputFile)
+        str_tmpFile         = os.path.join(str_dir, '.%s.tmp' % str_file)
         if fformat == 'dcm':
             if self._dcm:
                 self._dcm.pixel_array.flat = self._Mnp_2Dslice.flat
                 self._dcm.PixelData = self._dcm.pixel_array.tostring()
-                self._dcm.save_as(astr_outputFile)
+                self._dcm.save_as(str_tmpFile)
             else:
                 raise ValueError('dcm output format only available for DICOM files')
         else:
-            pylab.imsave(astr_outputFile, self._Mnp_2Dslice, format=fformat, cmap = cm.Greys_r)
+            pylab.imsave(str_tmpFile, self._Mnp_2Dslice, format=fformat, cmap = cm.Greys_r)
+        os.replace(str_tmpFile, astr_outputFile)
 
     def invert_slice_intensities(self):
         '''
@@ -489,9 +1120,34 @@ class med2image_dcm(med2image):
     def __init__(self, **kwargs):
         med2image.__init__(self, **kwargs)
 
+        self._b_multiFrame  = False
         self.l_dcmFileNames = sorted(glob.glob('%s/*.dcm' % self.str_inputDir))
         self.slices         = len(self.l_dcmFileNames)
-        if self._sliceToConvert != -1 or self.convertOnlySingleDICOM:
+        try:
+            dcm             = dicom.read_file(self.str_inputFile,force=True,
+                                              defer_size=med2image_dcm.deferSize)
+            frames          = int(dcm.get('NumberOfFrames', 1) or 1)
+        except Exception as e:
+            self.input_fail(self.str_inputFile, e)
+            frames          = 1
+        if frames > 1:
+            # A multi-frame object is a volume in itself, with its frames
+            # as the slices. Frames are only decoded as they are needed.
+            if self.str_outputFileType.endswith('dcm'):
+                raise ValueError('dcm output format not available for multi-frame DICOM files')
+            self._b_multiFrame      = True
+            self._b_3D              = True
+            self._dcm               = dcm
+            self._Vnp_3DVol         = dcm_frameStack(dcm, self.str_inputFile)
+            self.slices             = self._Vnp_3DVol.shape[2]
+            self.lstr_inputFile.append(os.path.basename(self.str_inputFile))
+            if self._b_convertMiddleSlice or self._b_convertMiddleFrame:
+                self._sliceToConvert    = int(self.slices/2)
+            elif self._sliceToConvert == -1:
+                self._sliceToConvert    = self._frameToConvert
+        elif self._sliceToConvert != -1 or self.convertOnlySingleDICOM:
+            if len(self.str_manifestDir):
+                raise ValueError('a single DICOM slice cannot be sharded with a manifest')
             if self._b_convertMiddleSlice:
                 self._sliceToConvert    = int(self.slices/2)
                 self._dcm               = dicom.read_file(self.l_dcmFileNames[self._sliceToConvert],force=True)
@@ -507,26 +1163,52 @@ class med2image_dcm(med2image):
             self.lstr_inputFile.append(os.path.basename(self.str_inputFile))
         else:
             self._b_3D              = True
-            self._dcm               = dicom.read_file(self.str_inputFile,force=True)
-            image                   = self._dcm.pixel_array
-            shape2D                 = image.shape
+            # The slice size is taken from the reference file or, if it
+            # cannot be read, from the first series file that can.
+            shape2D                 = None
+            for img in [self.str_inputFile] + self.l_dcmFileNames:
+                try:
+                    self._dcm, image    = med2image_dcm.pixelData_read(img)
+                    shape2D             = image.shape
+                    break
+                except Exception as e:
+                    if img == self.str_inputFile:
+                        self.input_fail(img, e)
+            if shape2D is None:
+                self.warn('inputFileFail',
+                          '\nNo DICOM file in %s could be read' % self.str_inputDir, True)
             #print(shape2D)
-            self._Vnp_3DVol         = np.empty( (shape2D[0], shape2D[1], self.slices) )
+            # Each slice is stored contiguously in a (slices, rows, cols)
+            # array, of which the (rows, cols, slices) volume is a view,
+            # rather than scattered with a stride of the number of slices.
+            Vnp_buffer              = np.empty( (self.slices, shape2D[0], shape2D[1]) )
             i                       = 0
             for img in self.l_dcmFileNames:
-                self._dcm           = dicom.read_file(img,force=True)
                 self.lstr_inputFile.append(os.path.basename(img))
-                image               = self._dcm.pixel_array
-                self._dcmList.append(self._dcm)
-                #print('%s: %s' % (img, image.shape))
                 try:
-                    self._Vnp_3DVol[:,:,i] = image
+                    dcm, image          = med2image_dcm.pixelData_read(img)
+                    self._dcmList.append(dcm)
+                    #print('%s: %s' % (img, image.shape))
+                    Vnp_buffer[i]       = image
                 except Exception as e:
+                    # When checkpointing, a bad input is recorded and its
+                    # slice skipped rather than aborting the whole series.
                     self.warn(
                     'dcmInsertionFail',
                     '\nFor input DICOM file %s, %s' % (img, str(e)),
-                    True)
+                    not self._b_checkpoint)
+                    if len(self._dcmList) == i:
+                        self._dcmList.append(None)
+                    Vnp_buffer[i]       = 0
+                    self._s_badSlices.add(i)
+                    self._l_journalErrors.append('%s %s' % (img, str(e)))
                 i += 1
+            self._Vnp_3DVol         = Vnp_buffer.transpose(1, 2, 0)
+            # Header tags and the reference slice come from the last good
+            # file of the series.
+            l_dcm                   = [dcm for dcm in self._dcmList if dcm is not None]
+            if len(l_dcm):
+                self._dcm           = l_dcm[-1]
         if self.str_outputFileStem.startswith('%'):
             str_spec                = self.str_outputFileStem
             self.str_outputFileStem = ''
@@ -543,8 +1225,92 @@ class med2image_dcm(med2image):
                     self.str_outputFileStem = str_fileComponent
                 else:
                     self.str_outputFileStem = self.str_outputFileStem + '-' + str_fileComponent
-        image = self._dcm.pixel_array
-        self._Mnp_2Dslice = image
+        if not self._b_multiFrame:
+            image = self._dcm.pixel_array
+            self._Mnp_2Dslice = image
+
+    # Elements larger than this (in bytes), notably the PixelData, are
+    # not read when parsing a DICOM header, but only when accessed.
+    deferSize   = 256
+
+    def input_fail(self, str_file, e):
+        '''
+        Report a failure to read the reference DICOM <str_file>. This is
+        fatal, unless checkpointing, in which case the error is recorded
+        (unless <str_file> is part of the series, whose failed files are
+        recorded as they are read) and the conversion continues.
+        '''
+        self.warn(
+        'inputFileFail',
+        '\nFor input DICOM file %s, %s' % (str_file, str(e)),
+        not self._b_checkpoint)
+        if str_file not in self.l_dcmFileNames:
+            self._l_journalErrors.append('%s %s' % (str_file, str(e)))
+
+    @staticmethod
+    def pixelData_read(str_file):
+        '''
+        Read the DICOM <str_file> with a deferred PixelData, returning the
+        dataset and its 2D image, memory mapped where possible.
+        '''
+        dcm         = dicom.read_file(str_file,force=True,
+                                      defer_size=med2image_dcm.deferSize)
+        image       = med2image_dcm.pixelData_map(dcm, str_file)
+        if image is None:
+            image   = dcm.pixel_array
+        return dcm, image
+
+    @staticmethod
+    def pixelData_map(dcm, str_file):
+        '''
+        For uncompressed, single sample DICOM data, return a read-only
+        memory map of the 2D image (or the (frames, rows, cols) stack of
+        a multi-frame object) in <str_file>, without pydicom reading (or
+        decoding) the PixelData.
+
+        The PixelData is expected as the last element of the file; its
+        offset follows from the image size given in the header of <dcm>,
+        and is verified against the PixelData element tag and length.
+
+        Assigning this map into the volume copies the pixels straight
+        from the file, bypassing the copies of a full pydicom decode.
+
+        Returns None if the pixel data needs to be decoded by pydicom.
+        '''
+        try:
+            str_syntax  = dcm.file_meta.TransferSyntaxUID
+            if str_syntax not in [ImplicitVRLittleEndian, ExplicitVRLittleEndian]:
+                return None
+            if int(dcm.get('SamplesPerPixel', 1)) != 1:             return None
+            if int(dcm.BitsAllocated) not in [8, 16, 32]:           return None
+            frames      = int(dcm.get('NumberOfFrames', 1) or 1)
+            rows        = int(dcm.Rows)
+            cols        = int(dcm.Columns)
+            dtype       = pixel_dtype(dcm)
+        except (AttributeError, KeyError, ValueError, TypeError):
+            return None
+        shape           = (frames, rows, cols) if frames > 1 else (rows, cols)
+        length          = frames * rows * cols * dtype.itemsize
+        length         += length % 2
+        offset          = os.path.getsize(str_file) - length
+        if str_syntax == ExplicitVRLittleEndian:
+            str_header  = b'\xe0\x7f\x10\x00' + b'OW\x00\x00' + length.to_bytes(4, 'little')
+            str_headerB = b'\xe0\x7f\x10\x00' + b'OB\x00\x00' + length.to_bytes(4, 'little')
+        else:
+            str_header  = b'\xe0\x7f\x10\x00' + length.to_bytes(4, 'little')
+            str_headerB = str_header
+        if offset < len(str_header):
+            return None
+        with open(str_file, 'rb') as f:
+            f.seek(offset - len(str_header))
+            str_read    = f.read(len(str_header))
+        if str_read not in [str_header, str_headerB]:
+            return None
+        return np.memmap(   str_file,
+                            dtype   = dtype,
+                            mode    = 'r',
+                            offset  = offset,
+                            shape   = shape)
 
     @staticmethod
     def sanitize(value):
@@ -562,27 +1328,6 @@ class med2image_dcm(med2image):
             value = med2image_dcm.sanitize(dcm.data_element(field).value)
         return value
 
-    def warn(self, str_tag, str_extraMsg = '', b_exit = False):
-        '''
-        Print a warning using the passed <str_tag>
-        '''
-        str_action      = med2image._dictErr[str_tag]['action']
-        str_error       = med2image._dictErr[str_tag]['error']
-        exitCode        = med2image._dictErr[str_tag]['exitCode']
-        self.LOG(
-            'Some error seems to have occured!', comms = 'error'
-        )
-        self.LOG(
-            'While %s' % str_action, comms = 'error'
-        )
-        self.LOG(
-            '%s' % str_error, comms = 'error'
-        )
-        if len(str_extraMsg):
-            self.LOG(str_extraMsg, comms = 'error')
-        if b_exit:
-            sys.exit(exitCode)
-
     def run(self):
         '''
         Runs the DICOM conversion based on internal state.
@@ -621,8 +1366,8 @@ class med2image_dcm(med2image):
             self.LOG('\tProtocolName:           %s' % 'ProtocolName not found in DCM header.')
             self.warn( 'ProtocolNameTag')
 
-        l_rot90 = [ bool(int(self.rot[0])), bool(int(self.rot[1])), bool(int(self.rot[2])) ]
         med2image.mkdir(self.str_outputDir)
+        self.journal_open()
         if not self._b_3D:
             if self.preserveDICOMinputName:
                 str_outputFile  = '%s/%s.%s' % (self.str_outputDir,
@@ -632,30 +1377,266 @@ class med2image_dcm(med2image):
                 str_outputFile  = '%s/%s.%s' % (self.str_outputDir,
                                         self.str_outputFileStem,
                                         self.str_outputFileType)
+            d_level     = self.pyramid_levels(np.asarray(self._Mnp_2Dslice), [0, 1])
             self.process_slice()
             self.slice_save(str_outputFile)
+            for size, Mnp_level in d_level.items():
+                self._Mnp_2Dslice = Mnp_level
+                self.process_slice()
+                self.slice_save(med2image.output_file_sized(str_outputFile, size))
         if self._b_3D:
             dims            = self._Vnp_3DVol.shape
             self.LOG('Image volume logical (i, j, k) size: %s' % str(dims))
-            rotCount = 0
-            if self._b_reslice:
-                for dim in ['x', 'y', 'z']:
-                    self.dim_save(
-                            dimension   = dim,
-                            makeSubDir  = True,
-                            rot90       = l_rot90[rotCount],
-                            indexStart  = 0,
-                            indexStop = -1
-                        )
-                    rotCount += 1
+            if self._b_resample:
+                self.l_spacing  = self.spacing_get()
+            # Creating a manifest only needs the resampled shape
+            if self._b_resample and not self._b_manifestCreate:
+                self._Vnp_3DVol = self.volume_resample(self._Vnp_3DVol)
+                self._s_badSlices = self.resample_indices(self._s_badSlices, dims[2], 2)
+                self.LOG('Resampled from voxel spacing %s to size %s' %
+                            (str(self.l_spacing), str(self._Vnp_3DVol.shape)))
+            self.units_convert()
+            self.animations_save()
+
+    def spacing_get(self):
+        '''
+        Return the voxel spacing (row, column, slice) of the volume from
+        the DICOM header(s). The slice spacing is the distance between
+        the first two slice positions if known, else the spacing between
+        slices or slice thickness.
+
+        For multi-frame objects, the shared functional groups are also
+        searched.
+        '''
+        l_dcm       = [dcm for dcm in self._dcmList if dcm is not None]
+        if not len(l_dcm):
+            l_dcm   = [self._dcm]
+        l_source    = [l_dcm[0]]
+        try:
+            l_source.append(l_dcm[0].SharedFunctionalGroupsSequence[0].PixelMeasuresSequence[0])
+        except (AttributeError, IndexError):
+            pass
+        l_spacing   = [1.0, 1.0, 1.0]
+        for dcm in l_source:
+            if 'PixelSpacing' in dcm:
+                l_spacing[0:2] = [float(f) for f in dcm.PixelSpacing]
+            for str_tag in ['SliceThickness', 'SpacingBetweenSlices']:
+                if str_tag in dcm and dcm.data_element(str_tag).value:
+                    l_spacing[2] = float(dcm.data_element(str_tag).value)
+        if len(l_dcm) > 1 and 'ImagePositionPatient' in l_dcm[0] \
+                          and 'ImagePositionPatient' in l_dcm[1]:
+            f_dist  = np.linalg.norm(np.array(l_dcm[1].ImagePositionPatient, dtype = float) -
+                                     np.array(l_dcm[0].ImagePositionPatient, dtype = float))
+            if f_dist > 0:
+                l_spacing[2] = f_dist
+        return l_spacing
+
+    def get_output_file_name(self, **kwargs):
+        '''
+        The frames of a multi-frame object are named by frame index
+        along 'z'. Otherwise, as for any other volume.
+        '''
+        index       = kwargs.get('index', 0)
+        str_subDir  = kwargs.get('subDir', '')
+        if not self._b_multiFrame or str_subDir not in ['', 'z'] or \
+           len(kwargs.get('part', '')):
+            return super().get_output_file_name(**kwargs)
+        str_stem    = self.str_outputFileStem
+        if self.preserveDICOMinputName:
+            str_stem    = os.path.splitext(self.lstr_inputFile[0])[0]
+        return med2image.output_file_sized('%s/%s/%s-frame%03d.%s' % (
+                                    self.str_outputDir,
+                                    str_subDir,
+                                    str_stem,
+                                    index,
+                                    self.str_outputFileType),
+                                    kwargs.get('size', 0))
+
+    def units_enumerate(self):
+        '''
+        A DICOM series (or multi-frame object) is a single volume,
+        converted along 'z' (and 'x' and 'y' if reslicing). For a
+        multi-frame object, a single frame can be selected.
+        '''
+        l_rot90 = [ bool(int(self.rot[0])), bool(int(self.rot[1])), bool(int(self.rot[2])) ]
+        dims    = self._Vnp_3DVol.shape
+        if self._b_manifestCreate:
+            dims    = self.resample_shape(dims)
+        l_dim   = ['x', 'y', 'z'] if self._b_reslice else ['z']
+        dim_ix  = {'x':0, 'y':1, 'z':2}
+        l_unit  = []
+        for dim in l_dim:
+            sliceStart  = 0
+            sliceEnd    = dims[dim_ix[dim]]
+            if self._b_multiFrame and self._sliceToConvert != -1:
+                sliceStart  = self._sliceToConvert
+                sliceEnd    = self._sliceToConvert + 1
+            l_unit.append({
+                'frame':        0,
+                'dimension':    dim,
+                'makeSubDir':   self._b_reslice,
+                'rot90':        l_rot90[dim_ix[dim]],
+                'indexStart':   sliceStart,
+                'indexStop':    sliceEnd
+            })
+        return l_unit
+
+
+class dcm_frameStack(object):
+    '''
+    A (rows, cols, frames) volume view of a multi-frame DICOM object,
+    that decodes frames lazily.
+
+    Indexing a single frame, i.e. [:, :, i], decodes only that frame
+    (and a range of frames, [:, :, i:j], only those frames):
+    uncompressed pixel data is memory mapped, so only the frame itself is
+    read, while for encapsulated (compressed) pixel data only the
+    fragments of the one frame are read from the file, and decompressed.
+    Any other indexing, or array conversion, decodes the whole volume
+    once (in parallel threads for encapsulated data) and keeps it.
+    '''
+
+    def __init__(self, dcm, str_file):
+        self._dcm               = dcm
+        self.str_file           = str_file
+        self.frames             = int(dcm.NumberOfFrames)
+        self.shape              = (int(dcm.Rows), int(dcm.Columns), self.frames)
+        self._Vnp_frameMap      = med2image_dcm.pixelData_map(dcm, str_file)
+        self._b_encapsulated    = dcm.file_meta.TransferSyntaxUID.is_encapsulated
+        self._l_frameFragments  = None
+        self._l_frameBytes      = None
+        self._Vnp_3DVol         = None
+
+    def fragments_find(self):
+        '''
+        Locate (once) the fragments of each frame of encapsulated pixel
+        data, as a list (per frame) of (file offset, length) pairs, by
+        walking the item headers of the PixelData in the file, without
+        reading the pixel data itself.
+
+        Fragments are assigned to frames by the Extended or Basic Offset
+        Table or, lacking both, one fragment per frame. Returns None if
+        the frames cannot be told apart this way.
+        '''
+        if self._l_frameFragments is not None:
+            return self._l_frameFragments
+        with open(self.str_file, 'rb') as f:
+            # pydicom stops (and rewinds) at the start of the PixelData
+            dicom.dcmread(f, force = True, stop_before_pixels = True)
+            if f.read(12) != b'\xe0\x7f\x10\x00OB\x00\x00\xff\xff\xff\xff':
+                return None
+            l_item      = []
+            while True:
+                str_header  = f.read(8)
+                if len(str_header) < 8 or str_header[0:4] != b'\xfe\xff\x00\xe0':
+                    break
+                length      = int.from_bytes(str_header[4:8], 'little')
+                l_item.append((f.tell(), length))
+                f.seek(length, os.SEEK_CUR)
+        if not len(l_item):
+            return None
+        (offset, length), l_fragment    = l_item[0], l_item[1:]
+        if 'ExtendedOffsetTable' in self._dcm:
+            l_offset    = list(np.frombuffer(self._dcm.ExtendedOffsetTable, dtype = '<u8'))
+        elif length:
+            with open(self.str_file, 'rb') as f:
+                f.seek(offset)
+                l_offset = list(np.frombuffer(f.read(length), dtype = '<u4'))
+        elif len(l_fragment) == self.frames:
+            l_offset    = [o - l_fragment[0][0] for o, n in l_fragment]
+        else:
+            return None
+        if len(l_offset) != self.frames or not len(l_fragment):
+            return None
+        # Offsets are relative to the item header of the first fragment
+        v_frame     = np.searchsorted(l_offset, [o - l_fragment[0][0] for o, n in l_fragment],
+                                      side = 'right') - 1
+        self._l_frameFragments  = [[] for k in range(self.frames)]
+        for k, fragment in zip(v_frame, l_fragment):
+            if k >= 0:
+                self._l_frameFragments[k].append(fragment)
+        return self._l_frameFragments
+
+    def frame_bytes(self, index):
+        '''
+        The compressed bytes of frame <index> of encapsulated pixel data:
+        read from the file if its fragments could be located, else split
+        (once) from the whole PixelData.
+        '''
+        l_frameFragments        = self.fragments_find()
+        if l_frameFragments is not None:
+            with open(self.str_file, 'rb') as f:
+                l_bytes         = []
+                for offset, length in l_frameFragments[index]:
+                    f.seek(offset)
+                    l_bytes.append(f.read(length))
+            return b''.join(l_bytes)
+        if self._l_frameBytes is None:
+            self._l_frameBytes  = list(generate_pixel_data_frame(
+                                        self._dcm.PixelData, self.frames))
+        return self._l_frameBytes[index]
+
+    def frame_decode(self, index):
+        '''
+        Decode the single frame <index> of encapsulated pixel data, by
+        wrapping it as a single frame dataset for pydicom to decode.
+        '''
+        dcm                     = dicom.Dataset()
+        dcm.file_meta           = copy.deepcopy(self._dcm.file_meta)
+        dcm.is_little_endian    = self._dcm.is_little_endian
+        dcm.is_implicit_VR      = self._dcm.is_implicit_VR
+        for str_tag in ['Rows', 'Columns', 'SamplesPerPixel',
+                        'PhotometricInterpretation', 'PlanarConfiguration',
+                        'BitsAllocated', 'BitsStored', 'HighBit',
+                        'PixelRepresentation']:
+            if str_tag in self._dcm:
+                setattr(dcm, str_tag, self._dcm.data_element(str_tag).value)
+        dcm.NumberOfFrames      = 1
+        dcm.PixelData           = encapsulate([self.frame_bytes(index)])
+        return dcm.pixel_array
+
+    def frame_get(self, index):
+        '''
+        Return the single frame <index> as a float 2D image.
+        '''
+        if self._Vnp_3DVol is not None:
+            return self._Vnp_3DVol[:, :, index]
+        if self._Vnp_frameMap is not None:
+            return np.asarray(self._Vnp_frameMap[index], dtype = float)
+        if self._b_encapsulated:
+            return np.asarray(self.frame_decode(index), dtype = float)
+        return np.asarray(self._dcm.pixel_array[index], dtype = float)
+
+    def volume(self):
+        '''
+        Return (and keep) the whole decoded volume.
+        '''
+        if self._Vnp_3DVol is None:
+            if self._Vnp_frameMap is None and self._b_encapsulated:
+                if self.fragments_find() is None:
+                    # Split the whole PixelData once, ahead of the threads
+                    self.frame_bytes(0)
+                with ThreadPoolExecutor() as executor:
+                    l_frame = list(executor.map(self.frame_decode, range(self.frames)))
             else:
-                self.dim_save(
-                            dimension   = 'z',
-                            makeSubDir  = False,
-                            rot90       = l_rot90[2],
-                            indexStart  = 0,
-                            indexStop   = -1
-                        )
+                l_frame = [self.frame_get(i) for i in range(self.frames)]
+            self._Vnp_3DVol     = np.stack(l_frame, axis = 2).astype(float)
+        return self._Vnp_3DVol
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple) and len(key) == 3 and \
+           key[0] == slice(None) and key[1] == slice(None):
+            if isinstance(key[2], (int, np.integer)):
+                return self.frame_get(key[2])
+            if isinstance(key[2], slice) and self._Vnp_3DVol is None:
+                return np.stack([self.frame_get(i) for i in
+                                 range(*key[2].indices(self.frames))], axis = 2)
+        return self.volume()[key]
+
+    def __array__(self, dtype = None, copy = None):
+        if dtype is None:
+            return self.volume()
+        return self.volume().astype(dtype)
 
 
 class med2image_nii(med2image):
@@ -673,6 +1654,8 @@ class med2image_nii(med2image):
         med2image.__init__(self, **kwargs)
         nimg = nib.load(self.str_inputFile)
         data = nimg.get_data()
+        self.l_spacing          = [float(f) for f in nimg.header.get_zooms()[0:3]]
+        self._resampledFrame    = -1
         if data.ndim == 4:
             self._Vnp_4DVol     = data
             self._b_4D          = True
@@ -688,18 +1671,42 @@ class med2image_nii(med2image):
         self.LOG('About to perform NifTI to %s conversion...\n' %
                   self.str_outputFileType)
 
+        if self._b_4D:
+            self.LOG('4D volume detected.\n')
+        if self._b_3D:
+            self.LOG('3D volume detected.\n')
+
+        if self._b_resample:
+            self.LOG('Resampling voxel spacing %s to %s.\n' %
+                        (str(self.l_spacing), str(self.resample_spacing())))
+            # Creating a manifest only needs the resampled shape
+            if self._b_3D and not self._b_manifestCreate:
+                self._Vnp_3DVol = self.volume_resample(self._Vnp_3DVol)
+
+        med2image.mkdir(self.str_outputDir)
+        self.journal_open()
+        self.units_convert()
+        self.animations_save()
+
+    def units_enumerate(self):
+        '''
+        Each (selected) frame is converted along 'z' (and 'x' and 'y' if
+        reslicing), either for all slices or for the selected slice.
+        '''
         frames     = 1
         frameStart = 0
         frameEnd   = 0
-
-        sliceStart = 0
-        sliceEnd   = 0
+        # Only a 3D volume is resampled up front, and not when creating a
+        # manifest
+        if self._b_3D and not self._b_manifestCreate:
+            dims   = self._Vnp_3DVol.shape
+        elif self._b_3D:
+            dims   = self.resample_shape(self._Vnp_3DVol.shape)
+        else:
+            dims   = self.resample_shape(self._Vnp_4DVol.shape[0:3])
 
         if self._b_4D:
-            self.LOG('4D volume detected.\n')
             frames = self._Vnp_4DVol.shape[3]
-        if self._b_3D:
-            self.LOG('3D volume detected.\n')
 
         if self._b_convertMiddleFrame:
             self._frameToConvert = int(frames/2)
@@ -710,25 +1717,41 @@ class med2image_nii(med2image):
             frameStart  = self._frameToConvert
             frameEnd    = self._frameToConvert + 1
 
-        for f in range(frameStart, frameEnd):
-            if self._b_4D:
-                self._Vnp_3DVol = self._Vnp_4DVol[:,:,:,f]
-            slices     = self._Vnp_3DVol.shape[2]
-            if self._b_convertMiddleSlice:
-                self._sliceToConvert = int(slices/2)
-
-            if self._sliceToConvert == -1:
-                sliceEnd    = -1
-            else:
-                sliceStart  = self._sliceToConvert
-                sliceEnd    = self._sliceToConvert + 1
+        if self._b_convertMiddleSlice:
+            self._sliceToConvert = int(dims[2]/2)
 
-            med2image.mkdir(self.str_outputDir)
-            if self._b_reslice:
-                for dim in ['x', 'y', 'z']:
-                    self.dim_save(dimension = dim, makeSubDir = True, indexStart = sliceStart, indexStop = sliceEnd, rot90 = True, frame = f)
-            else:
-                self.dim_save(dimension = 'z', makeSubDir = False, indexStart = sliceStart, indexStop = sliceEnd, rot90 = True, frame = f)
+        l_dim   = ['x', 'y', 'z'] if self._b_reslice else ['z']
+        dim_ix  = {'x':0, 'y':1, 'z':2}
+        l_unit  = []
+        for f in range(frameStart, frameEnd):
+            for dim in l_dim:
+                if self._sliceToConvert == -1:
+                    sliceStart  = 0
+                    sliceEnd    = dims[dim_ix[dim]]
+                else:
+                    sliceStart  = self._sliceToConvert
+                    sliceEnd    = self._sliceToConvert + 1
+                l_unit.append({
+                    'frame':        f,
+                    'dimension':    dim,
+                    'makeSubDir':   self._b_reslice,
+                    'rot90':        True,
+                    'indexStart':   sliceStart,
+                    'indexStop':    sliceEnd
+                })
+        return l_unit
+
+    def unit_save(self, d_unit):
+        '''
+        Select the frame of a 4D volume before converting a unit. When
+        resampling, each frame is only resampled once for all its units.
+        '''
+        if self._b_4D and not self._b_resample:
+            self._Vnp_3DVol = self._Vnp_4DVol[:,:,:,d_unit['frame']]
+        if self._b_4D and self._b_resample and self._resampledFrame != d_unit['frame']:
+            self._Vnp_3DVol         = self.volume_resample(self._Vnp_4DVol[:,:,:,d_unit['frame']])
+            self._resampledFrame    = d_unit['frame']
+        self.dim_save(**d_unit)
 
 class object_factoryCreate:
     """
@@ -807,6 +1830,21 @@ class object_factoryCreate:
                 showSlices              = args.showSlices,
                 func                    = args.func,
                 reslice                 = args.reslice,
+                skipEmptySlices         = args.skipEmptySlices,
+                emptySliceThreshold     = args.emptySliceThreshold,
+                emptySlicePlaceholder   = args.emptySlicePlaceholder,
+                checkpoint              = args.checkpoint,
+                manifestDir             = args.manifestDir,
+                manifestCreate          = args.manifestCreate,
+                shardSize               = args.shardSize,
+                leaseTime               = args.leaseTime,
+                resample                = args.resample,
+                resampleSpacing         = args.resampleSpacing,
+                pyramid                 = args.pyramid,
+                montage                 = args.montage,
+                montageColumns          = args.montageColumns,
+                animate                 = args.animate,
+                frameDuration           = args.frameDuration,
                 verbosity               = args.verbosity
             )
 
@@ -820,11 +1858,27 @@ class object_factoryCreate:
                 outputFileStem          = args.outputFileStem,
                 outputFileType          = args.outputFileType,
                 sliceToConvert          = args.sliceToConvert,
+                frameToConvert          = args.frameToConvert,
                 convertOnlySingleDICOM  = args.convertOnlySingleDICOM,
                 preserveDICOMinputName  = args.preserveDICOMinputName,
                 reslice                 = args.reslice,
                 rot                     = args.rot,
                 rotAngle                = args.rotAngle,
                 func                    = args.func,
+                skipEmptySlices         = args.skipEmptySlices,
+                emptySliceThreshold     = args.emptySliceThreshold,
+                emptySlicePlaceholder   = args.emptySlicePlaceholder,
+                checkpoint              = args.checkpoint,
+                manifestDir             = args.manifestDir,
+                manifestCreate          = args.manifestCreate,
+                shardSize               = args.shardSize,
+                leaseTime               = args.leaseTime,
+                resample                = args.resample,
+                resampleSpacing         = args.resampleSpacing,
+                pyramid                 = args.pyramid,
+                montage                 = args.montage,
+                montageColumns          = args.montageColumns,
+                animate                 = args.animate,
+                frameDuration           = args.frameDuration,
                 verbosity               = args.verbosity
             )
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+#
+# Shared fixtures of the med2image regression tests: small, seeded
+# NIfTI and DICOM inputs generated once per test session.
+#
+
+import  os
+import  numpy as np
+import  pytest
+import  nibabel             as      nib
+from    pydicom.uid         import  ExplicitVRLittleEndian, RLELossless
+
+from    testdata            import  G_spacing, volume_make, dcm_make, series_write
+
+
+def pytest_addoption(parser):
+    parser.addoption('--update-golden',
+                     action  = 'store_true',
+                     default = False,
+                     help    = 'regenerate the golden results from the current outputs')
+
+
+@pytest.fixture(scope = 'session')
+def update_golden(request):
+    return request.config.getoption('--update-golden')
+
+
+@pytest.fixture(scope = 'session')
+def inputs(tmp_path_factory):
+    '''
+    A dictionary of the generated input files.
+    '''
+    str_dir     = str(tmp_path_factory.mktemp('inputs'))
+    d_input     = {}
+    Vnp         = volume_make()
+    affine      = np.diag(G_spacing + [1.0])
+
+    d_input['nii3D']    = '%s/vol3D.nii' % str_dir
+    nib.save(nib.Nifti1Image(Vnp, affine), d_input['nii3D'])
+
+    d_input['nii4D']    = '%s/vol4D.nii' % str_dir
+    Vnp_4D              = np.stack([Vnp * (f + 1) for f in range(4)], axis = -1)
+    nib.save(nib.Nifti1Image(Vnp_4D, affine), d_input['nii4D'])
+
+    # Slices that are empty in some frames only
+    d_input['nii4DEmpty']   = '%s/vol4DEmpty.nii' % str_dir
+    Vnp_4D[:, :, 5, 1]      = 0
+    Vnp_4D[:, :, 6, 0:2]    = 0
+    nib.save(nib.Nifti1Image(Vnp_4D, affine), d_input['nii4DEmpty'])
+
+    str_series          = series_write('%s/series' % str_dir, Vnp)
+    d_input['dcm']      = '%s/slice000.dcm' % str_series
+    d_input['dcmSlice'] = '%s/slice005.dcm' % str_series
+
+    Vnp_frames          = volume_make((7, 16, 20), seed = 1).astype(np.uint16)
+    for str_name, str_syntax in [('multiFrame', ExplicitVRLittleEndian),
+                                 ('multiFrameRLE', RLELossless)]:
+        os.makedirs('%s/%s' % (str_dir, str_name))
+        dcm     = dcm_make(Vnp_frames, NumberOfFrames = Vnp_frames.shape[0])
+        if str_syntax != ExplicitVRLittleEndian:
+            dcm.compress(str_syntax, Vnp_frames)
+        d_input[str_name]   = '%s/%s/multi.dcm' % (str_dir, str_name)
+        dcm.save_as(d_input[str_name], write_like_original = False)
+    return d_input
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+#
+# Speed and memory of optimized conversion paths, each compared against
+# its reference (unoptimized) path on the same input in the same run.
+# Both paths must give identical data; the optimized path must not be
+# slower than the reference (beyond timing noise), or use more memory
+# than the reference by more than the tolerance below.
+#
+# Memory is the peak traced by tracemalloc, which sees the (numpy and
+# pydicom) allocations of a path, but not the pages of memory mapped
+# files. The memory check of a memory mapped path therefore only covers
+# its allocations, and cannot catch a regression in how much of the
+# mapped file is read.
+#
+
+import  os
+import  time
+import  tracemalloc
+import  numpy as np
+import  pytest
+import  pydicom             as      dicom
+from    pydicom.uid         import  RLELossless
+
+from    med2image.med2image import  med2image_dcm, dcm_frameStack
+from    testdata            import  volume_make, series_write, dcm_make
+
+# Allowed relative timing noise of the optimized vs reference time, and
+# ratio of optimized to reference peak memory.
+G_timeNoise         = 0.05
+G_memoryTolerance   = 1.1
+
+
+def measure(func, repeat = 3):
+    '''
+    Return the result, best time and peak traced memory of <func>().
+    '''
+    f_time          = float('inf')
+    for r in range(repeat):
+        f_start     = time.perf_counter()
+        result      = func()
+        f_time      = min(f_time, time.perf_counter() - f_start)
+    tracemalloc.start()
+    func()
+    _, peak         = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, f_time, peak
+
+
+def assert_within(f_time, peak, f_timeRef, peakRef):
+    assert f_time   <= f_timeRef * (1 + G_timeNoise), \
+        'optimized %.4fs vs reference %.4fs' % (f_time, f_timeRef)
+    assert peak     <= peakRef * G_memoryTolerance, \
+        'optimized %d bytes vs reference %d bytes' % (peak, peakRef)
+
+
+@pytest.fixture(scope = 'module')
+def series(tmp_path_factory):
+    str_dir = str(tmp_path_factory.mktemp('perfSeries'))
+    series_write(str_dir, volume_make((256, 256, 64)))
+    return '%s/slice000.dcm' % str_dir
+
+
+@pytest.fixture(scope = 'module')
+def multiFrame(tmp_path_factory):
+    str_file    = str(tmp_path_factory.mktemp('perfMultiFrame') / 'multi.dcm')
+    Vnp         = volume_make((64, 256, 256)).astype(np.uint16)
+    dcm_make(Vnp, NumberOfFrames = Vnp.shape[0]).save_as(str_file, write_like_original = False)
+    return str_file
+
+
+@pytest.fixture(scope = 'module')
+def multiFrameRLE(tmp_path_factory):
+    str_file    = str(tmp_path_factory.mktemp('perfMultiFrameRLE') / 'multi.dcm')
+    Vnp         = volume_make((128, 128, 128)).astype(np.uint16)
+    dcm         = dcm_make(Vnp, NumberOfFrames = Vnp.shape[0])
+    dcm.compress(RLELossless, Vnp)
+    dcm.save_as(str_file, write_like_original = False)
+    return str_file
+
+
+def test_series_memmap_vs_pydicom(series, monkeypatch):
+    '''
+    Assembling a DICOM series volume with memory mapped pixel data, vs
+    a full pydicom decode of each file.
+    '''
+    def volume_read():
+        return med2image_dcm(inputFile = series, verbosity = 0)._Vnp_3DVol
+
+    Vnp, f_time, peak       = measure(volume_read)
+    monkeypatch.setattr(med2image_dcm, 'pixelData_map', staticmethod(lambda dcm, str_file: None))
+    Vnp_ref, f_timeRef, peakRef = measure(volume_read)
+    assert np.array_equal(Vnp, Vnp_ref)
+    assert_within(f_time, peak, f_timeRef, peakRef)
+
+
+def test_multiFrame_lazy_vs_full_decode(multiFrame):
+    '''
+    Reading the middle frame of a multi-frame object lazily, vs decoding
+    all its frames.
+    '''
+    def frame_lazy():
+        dcm = dicom.read_file(multiFrame, defer_size = med2image_dcm.deferSize)
+        return dcm_frameStack(dcm, multiFrame)[:, :, 32]
+
+    def frame_full():
+        return dicom.read_file(multiFrame).pixel_array[32].astype(float)
+
+    Mnp, f_time, peak               = measure(frame_lazy)
+    Mnp_ref, f_timeRef, peakRef     = measure(frame_full)
+    assert np.array_equal(Mnp, Mnp_ref)
+    assert_within(f_time, peak, f_timeRef, peakRef)
+
+
+def test_multiFrameRLE_lazy_vs_full_decode(multiFrameRLE):
+    '''
+    Reading the middle frame of an encapsulated (RLE) multi-frame object
+    lazily, from the fragments of that frame only, vs decoding all its
+    frames. The lazy read must not hold (most of) the compressed pixel
+    data of the other frames either.
+    '''
+    def frame_lazy():
+        dcm = dicom.read_file(multiFrameRLE, defer_size = med2image_dcm.deferSize)
+        return dcm_frameStack(dcm, multiFrameRLE)[:, :, 64]
+
+    def frame_full():
+        return dicom.read_file(multiFrameRLE).pixel_array[64].astype(float)
+
+    Mnp, f_time, peak               = measure(frame_lazy)
+    Mnp_ref, f_timeRef, peakRef     = measure(frame_full)
+    assert np.array_equal(Mnp, Mnp_ref)
+    assert_within(f_time, peak, f_timeRef, peakRef)
+    assert peak < os.path.getsize(multiFrameRLE) / 2
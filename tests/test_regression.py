@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+#
+# Output regression tests: each case converts one of the generated
+# inputs and compares the output file names and decoded pixel data
+# against the golden results stored in 'golden/<case>.npz'.
+#
+# Regenerate the golden results (after an intended output change) with
+#
+#       python -m pytest tests --update-golden
+#
+
+import  os
+import  shutil
+import  multiprocessing
+import  numpy as np
+import  pytest
+import  nibabel             as      nib
+import  pydicom             as      dicom
+from    PIL                 import  Image, ImageSequence
+
+from    med2image.med2image import  med2image_dcm, med2image_nii
+from    testdata            import  volume_make
+
+G_goldenDir = os.path.join(os.path.dirname(__file__), 'golden')
+
+# Maximum absolute difference (in decoded uint8 intensity, or stored
+# DICOM value) allowed against the golden result, per output type.
+# Lossy jpg output is allowed to vary with the encoder.
+G_tolerance = {
+    'png':  1,
+    'gif':  1,
+    'jpg':  8,
+    'dcm':  0
+}
+
+# case: (converter, input, keyword arguments of the converter)
+G_cases = {
+    'nii3D_png':            (med2image_nii, 'nii3D',     {}),
+    'nii3D_jpg':            (med2image_nii, 'nii3D',     {'outputFileType': 'jpg'}),
+    'nii3D_middle':         (med2image_nii, 'nii3D',     {'sliceToConvert': 'm'}),
+    'nii3D_reslice':        (med2image_nii, 'nii3D',     {'reslice': True}),
+    'nii3D_rotAngle':       (med2image_nii, 'nii3D',     {'rotAngle': '45', 'sliceToConvert': '6'}),
+    'nii3D_invert':         (med2image_nii, 'nii3D',     {'func': 'invertIntensities'}),
+    'nii3D_resample':       (med2image_nii, 'nii3D',     {'reslice': True, 'resample': True}),
+    'nii3D_skipEmpty':      (med2image_nii, 'nii3D',     {'skipEmptySlices': True,
+                                                          'emptySlicePlaceholder': True}),
+    'nii3D_pyramid':        (med2image_nii, 'nii3D',     {'pyramid': '8,4'}),
+    'nii3D_pyramidRot':     (med2image_nii, 'nii3D',     {'pyramid': '8', 'rotAngle': '45',
+                                                          'sliceToConvert': '6'}),
+    'nii3D_montage':        (med2image_nii, 'nii3D',     {'reslice': True, 'montage': True}),
+    'nii4D_png':            (med2image_nii, 'nii4D',     {}),
+    'nii4D_middle':         (med2image_nii, 'nii4D',     {'frameToConvert': 'm', 'sliceToConvert': 'm',
+                                                          'reslice': True}),
+    'nii4D_animate':        (med2image_nii, 'nii4D',     {'outputFileType': 'gif', 'animate': True}),
+    'nii4D_animateEmpty':   (med2image_nii, 'nii4DEmpty', {'outputFileType': 'gif', 'animate': True,
+                                                          'montage': True, 'skipEmptySlices': True}),
+    'dcm2D_png':            (med2image_dcm, 'dcmSlice',  {'convertOnlySingleDICOM': True}),
+    'dcm2D_preserveName':   (med2image_dcm, 'dcmSlice',  {'convertOnlySingleDICOM': True,
+                                                          'preserveDICOMinputName': True}),
+    'dcm3D_png':            (med2image_dcm, 'dcm',       {}),
+    'dcm3D_jpg':            (med2image_dcm, 'dcm',       {'outputFileType': 'jpg'}),
+    'dcm3D_dcm':            (med2image_dcm, 'dcm',       {'outputFileType': 'dcm'}),
+    'dcm3D_tagStem':        (med2image_dcm, 'dcm',       {'outputFileStem': '%PatientID%ProtocolName',
+                                                          'sliceToConvert': '3'}),
+    'dcm3D_reslice':        (med2image_dcm, 'dcm',       {'reslice': True}),
+    'dcm3D_rot':            (med2image_dcm, 'dcm',       {'reslice': True, 'rot': '011',
+                                                          'rotAngle': '180'}),
+    'dcm3D_invert':         (med2image_dcm, 'dcm',       {'func': 'invertIntensities'}),
+    'dcm3D_resample':       (med2image_dcm, 'dcm',       {'reslice': True, 'resample': True}),
+    'dcmMultiFrame':        (med2image_dcm, 'multiFrame',    {}),
+    'dcmMultiFrame_middle': (med2image_dcm, 'multiFrame',    {'frameToConvert': 'm'}),
+    'dcmMultiFrameRLE':     (med2image_dcm, 'multiFrameRLE', {'reslice': True}),
+}
+
+
+def convert(converter, str_inputFile, str_outputDir, **kwargs):
+    '''
+    Run a conversion, with the same defaults as the med2image script.
+    '''
+    d_args = {
+        'inputFile':        str_inputFile,
+        'outputDir':        str_outputDir,
+        'outputFileStem':   'sample',
+        'outputFileType':   'png',
+        'sliceToConvert':   '-1',
+        'frameToConvert':   '-1',
+        'verbosity':        0
+    }
+    d_args.update(kwargs)
+    C_convert = converter(**d_args)
+    C_convert.run()
+    return C_convert
+
+
+def outputs_read(str_outputDir):
+    '''
+    Return a dictionary of all outputs in <str_outputDir>, keyed by
+    their relative file name: decoded image data (all frames, for
+    animations), DICOM pixel data, or text content.
+    '''
+    d_output = {}
+    for str_root, l_dir, l_file in os.walk(str_outputDir):
+        for str_file in l_file:
+            str_path    = os.path.join(str_root, str_file)
+            str_name    = os.path.relpath(str_path, str_outputDir)
+            str_ext     = str_file.split('.')[-1]
+            if str_ext == 'dcm':
+                d_output[str_name] = dicom.read_file(str_path).pixel_array
+            elif str_ext in ['png', 'jpg', 'gif']:
+                with Image.open(str_path) as image:
+                    d_output[str_name] = np.stack([np.asarray(frame.convert('RGBA'))
+                                                   for frame in ImageSequence.Iterator(image)])
+            else:
+                with open(str_path) as f:
+                    d_output[str_name] = np.array(f.read())
+    return d_output
+
+
+@pytest.mark.parametrize('str_case', sorted(G_cases))
+def test_output_regression(str_case, inputs, tmp_path, update_golden):
+    converter, str_input, d_kwargs  = G_cases[str_case]
+    str_outputDir                   = str(tmp_path / 'out')
+    convert(converter, inputs[str_input], str_outputDir, **d_kwargs)
+    d_output                        = outputs_read(str_outputDir)
+    str_golden                      = os.path.join(G_goldenDir, '%s.npz' % str_case)
+
+    if update_golden:
+        os.makedirs(G_goldenDir, exist_ok = True)
+        np.savez_compressed(str_golden, **d_output)
+        pytest.skip('golden result %s updated' % str_golden)
+    if not os.path.isfile(str_golden):
+        pytest.fail('no golden result %s -- run with --update-golden' % str_golden)
+
+    with np.load(str_golden) as d_golden:
+        assert sorted(d_output) == sorted(d_golden.files)
+        for str_name in d_golden.files:
+            Mnp_golden  = d_golden[str_name]
+            Mnp_output  = d_output[str_name]
+            assert Mnp_output.shape == Mnp_golden.shape, str_name
+            if Mnp_golden.dtype.kind in 'US':
+                assert Mnp_output == Mnp_golden, str_name
+                continue
+            f_diff      = np.abs(Mnp_output.astype(float) - Mnp_golden.astype(float)).max()
+            assert f_diff <= G_tolerance[str_name.split('.')[-1]], str_name
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_sharded_equals_direct(workers, inputs, tmp_path):
+    '''
+    A conversion spread over manifest units, by one or several worker
+    processes, gives the direct outputs. A unit whose lease was left
+    behind by a dead worker is reclaimed once the lease is stale.
+    '''
+    convert(med2image_nii, inputs['nii4D'], str(tmp_path / 'direct'), reslice = True)
+    str_manifestDir = str(tmp_path / 'manifest')
+    d_shard         = {'reslice': True, 'manifestDir': str_manifestDir, 'shardSize': 5}
+    convert(med2image_nii, inputs['nii4D'], str(tmp_path / 'sharded'),
+            manifestCreate = True, **d_shard)
+    str_lease       = '%s/unit00000.lease.0' % str_manifestDir
+    with open(str_lease, 'w') as f:
+        f.write('deadhost 0\n')
+    os.utime(str_lease, (0, 0))
+    l_worker        = [multiprocessing.Process(target = convert,
+                            args    = (med2image_nii, inputs['nii4D'], str(tmp_path / 'sharded')),
+                            kwargs  = d_shard)
+                       for w in range(workers)]
+    for worker in l_worker:
+        worker.start()
+    for worker in l_worker:
+        worker.join()
+        assert worker.exitcode == 0
+    assert os.path.isfile('%s/unit00000.lease.1' % str_manifestDir)
+    d_direct    = outputs_read(str(tmp_path / 'direct'))
+    d_sharded   = outputs_read(str(tmp_path / 'sharded'))
+    assert sorted(d_direct) == sorted(d_sharded)
+    for str_name in d_direct:
+        assert np.array_equal(d_direct[str_name], d_sharded[str_name]), str_name
+
+
+def test_manifest_create_only(inputs, tmp_path, monkeypatch):
+    '''
+    Creating a manifest neither resamples nor converts anything, yet
+    enumerates the units of the resampled volume that the workers then
+    convert into the direct outputs.
+    '''
+    d_shard     = {'reslice': True, 'resample': True, 'shardSize': 4,
+                   'manifestDir': str(tmp_path / 'manifest')}
+    convert(med2image_nii, inputs['nii3D'], str(tmp_path / 'direct'),
+            reslice = True, resample = True)
+    with monkeypatch.context() as patch:
+        patch.setattr(med2image_nii, 'volume_resample', None)
+        convert(med2image_nii, inputs['nii3D'], str(tmp_path / 'sharded'),
+                manifestCreate = True, **d_shard)
+    assert not os.listdir(str(tmp_path / 'sharded'))
+    convert(med2image_nii, inputs['nii3D'], str(tmp_path / 'sharded'), **d_shard)
+    d_direct    = outputs_read(str(tmp_path / 'direct'))
+    d_sharded   = outputs_read(str(tmp_path / 'sharded'))
+    assert sorted(d_direct) == sorted(d_sharded)
+    for str_name in d_direct:
+        assert np.array_equal(d_direct[str_name], d_sharded[str_name]), str_name
+    with pytest.raises(ValueError):
+        convert(med2image_dcm, inputs['dcmSlice'], str(tmp_path / 'slice'),
+                convertOnlySingleDICOM = True, manifestCreate = True, **d_shard)
+
+
+def test_manifest_lease(inputs, tmp_path):
+    '''
+    A lease is renewed by its holder, and can only be claimed by another
+    worker once it has expired.
+    '''
+    d_shard     = {'reslice': True, 'manifestDir': str(tmp_path / 'manifest'),
+                   'leaseTime': 60}
+    C_holder    = convert(med2image_nii, inputs['nii3D'], str(tmp_path / 'out'),
+                          manifestCreate = True, **d_shard)
+    C_other     = med2image_nii(inputFile = inputs['nii3D'], verbosity = 0, **d_shard)
+    assert C_holder.manifest_unitClaim(0)
+    assert not C_other.manifest_unitClaim(0)
+    os.utime(C_holder._str_lease, (0, 0))
+    C_holder.manifest_leaseRenew()
+    assert not C_other.manifest_unitClaim(0)
+    os.utime(C_holder._str_lease, (0, 0))
+    assert C_other.manifest_unitClaim(0)
+    assert C_other._str_lease != C_holder._str_lease
+
+
+def test_checkpoint_resume(inputs, tmp_path):
+    '''
+    A resumed conversion only redoes the units missing from the journal,
+    and ends with the outputs of an uninterrupted conversion.
+    '''
+    str_outputDir   = str(tmp_path / 'out')
+    C_convert       = convert(med2image_nii, inputs['nii3D'], str_outputDir,
+                              reslice = True, checkpoint = True)
+    d_full          = outputs_read(str_outputDir)
+    str_journal     = os.path.join(str_outputDir, 'sample-journal.txt')
+    with open(str_journal) as f:
+        l_line      = f.readlines()
+    # Interrupt after the first 'x' slices: only these remain done
+    with open(str_journal, 'w') as f:
+        f.writelines(l_line[0:10])
+    l_done          = []
+    for str_line in l_line[0:10]:
+        str_event, frame, str_dim, index = str_line.split()
+        l_done.append(C_convert.get_output_file_name(index = int(index), subDir = str_dim,
+                                                     frame = int(frame)))
+    for str_name in list(d_full):
+        str_file    = os.path.join(str_outputDir, str_name)
+        if str_file in l_done:
+            os.utime(str_file, (0, 0))
+        elif str_name.endswith('png'):
+            os.remove(str_file)
+    # A journaled output that has gone missing is not recreated either
+    os.remove(l_done[0])
+    convert(med2image_nii, inputs['nii3D'], str_outputDir, reslice = True, checkpoint = True)
+    d_resumed       = outputs_read(str_outputDir)
+    assert not os.path.isfile(l_done[0])
+    for str_file in l_done[1:]:
+        assert os.path.getmtime(str_file) == 0, str_file
+    for str_name in d_full:
+        if str_name.endswith('png') and os.path.join(str_outputDir, str_name) != l_done[0]:
+            assert np.array_equal(d_full[str_name], d_resumed[str_name]), str_name
+
+
+def test_empty_placeholder_blank(tmp_path):
+    '''
+    The shared placeholder of near-constant (empty) slices is blank,
+    rather than the (contrast stretched) noise of one of them.
+    '''
+    Vnp             = volume_make()
+    Vnp[:, :, 0:3]  = np.random.default_rng(0).integers(0, 4, Vnp[:, :, 0:3].shape)
+    str_inputFile   = str(tmp_path / 'noise.nii')
+    nib.save(nib.Nifti1Image(Vnp, np.eye(4)), str_inputFile)
+    str_outputDir   = str(tmp_path / 'out')
+    convert(med2image_nii, str_inputFile, str_outputDir, skipEmptySlices = True,
+            emptySlicePlaceholder = True, emptySliceThreshold = 5)
+    d_output        = outputs_read(str_outputDir)
+    Mnp_placeholder = d_output['sample-empty.png'][..., 0:3]
+    assert Mnp_placeholder.min() == Mnp_placeholder.max()
+    assert str(d_output['sample-empty.txt']).count('sample-empty.png') == 6
+    assert sorted(os.listdir(str_outputDir))[0] == 'sample-empty.png'
+
+
+@pytest.mark.parametrize('str_bad', ['slice000.dcm', 'slice011.dcm'])
+def test_checkpoint_bad_input(str_bad, inputs, tmp_path):
+    '''
+    A checkpointed DICOM conversion records an unreadable file of the
+    series (also the reference, or last, file) and skips its slice.
+    '''
+    str_inputDir    = str(tmp_path / 'series')
+    shutil.copytree(os.path.dirname(inputs['dcm']), str_inputDir)
+    str_file        = os.path.join(str_inputDir, str_bad)
+    with open(str_file, 'rb') as f:
+        str_header  = f.read(400)
+    with open(str_file, 'wb') as f:
+        f.write(str_header)
+    str_outputDir   = str(tmp_path / 'out')
+    convert(med2image_dcm, os.path.join(str_inputDir, 'slice000.dcm'), str_outputDir,
+            checkpoint = True)
+    d_output        = outputs_read(str_outputDir)
+    str_slice       = 'sample-%s.png' % os.path.splitext(str_bad)[0]
+    assert str_slice not in d_output
+    assert len([str_name for str_name in d_output if str_name.endswith('png')]) == 11
+    assert ('error %s ' % str_file) in str(d_output['sample-journal.txt'])
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+#
+# Builders of the seeded NIfTI and DICOM test inputs, shared by the
+# session fixtures in conftest.py and the performance tests.
+#
+
+import  os
+import  numpy as np
+import  pydicom             as      dicom
+from    pydicom.dataset     import  FileDataset, FileMetaDataset
+from    pydicom.uid         import  ExplicitVRLittleEndian
+
+# Anisotropic voxels (thick slices), with a zero padded border so that
+# empty slices exist along every dimension.
+G_spacing   = [1.0, 1.0, 2.5]
+
+
+def volume_make(shape = (16, 20, 12), seed = 0):
+    '''
+    A seeded int16 volume, zero outside a central box.
+    '''
+    rng         = np.random.default_rng(seed)
+    Vnp         = np.zeros(shape, dtype = np.int16)
+    l_box       = tuple(slice(n // 4, n - n // 4) for n in shape)
+    Vnp[l_box]  = rng.integers(1, 1000, Vnp[l_box].shape)
+    return Vnp
+
+
+def dcm_make(Vnp_slice, **kwargs):
+    '''
+    A minimal uncompressed MR DICOM dataset of the 2D (or, with a
+    NumberOfFrames, 3D (frames, rows, cols)) <Vnp_slice>.
+    '''
+    meta                            = FileMetaDataset()
+    meta.TransferSyntaxUID          = ExplicitVRLittleEndian
+    meta.MediaStorageSOPClassUID    = '1.2.840.10008.5.1.4.1.1.4'
+    meta.MediaStorageSOPInstanceUID = dicom.uid.generate_uid()
+    dcm                             = FileDataset('', {}, file_meta = meta, preamble = b'\0' * 128)
+    dcm.is_little_endian            = True
+    dcm.is_implicit_VR              = False
+    dcm.SOPClassUID                 = meta.MediaStorageSOPClassUID
+    dcm.SOPInstanceUID              = meta.MediaStorageSOPInstanceUID
+    dcm.PatientName                 = 'anonymized'
+    dcm.PatientID                   = '1449c1d'
+    dcm.PatientAge                  = '030Y'
+    dcm.PatientSex                  = 'F'
+    dcm.SeriesDescription           = 'regression'
+    dcm.ProtocolName                = 'SAG MPRAGE'
+    dcm.Rows, dcm.Columns           = Vnp_slice.shape[-2:]
+    dcm.SamplesPerPixel             = 1
+    dcm.PhotometricInterpretation   = 'MONOCHROME2'
+    dcm.BitsAllocated               = 16
+    dcm.BitsStored                  = 16
+    dcm.HighBit                     = 15
+    dcm.PixelRepresentation         = 1 if Vnp_slice.dtype.kind == 'i' else 0
+    dcm.PixelSpacing                = G_spacing[0:2]
+    dcm.SliceThickness              = G_spacing[2]
+    for key, value in kwargs.items():
+        setattr(dcm, key, value)
+    dcm.PixelData                   = np.ascontiguousarray(Vnp_slice).tobytes()
+    return dcm
+
+
+def series_write(str_dir, Vnp):
+    '''
+    Write <Vnp> as a series of single frame DICOM files, one per slice.
+    '''
+    os.makedirs(str_dir, exist_ok = True)
+    for k in range(Vnp.shape[2]):
+        dcm = dcm_make(Vnp[:, :, k],
+                       InstanceNumber       = k + 1,
+                       ImagePositionPatient = [0.0, 0.0, G_spacing[2] * k])
+        dcm.save_as('%s/slice%03d.dcm' % (str_dir, k), write_like_original = False)
+    return str_dir